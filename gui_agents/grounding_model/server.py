@@ -3,27 +3,75 @@ FastAPI proxy for the grounding model that forwards OpenAI-format requests
 to a local backend and normalises the responses.
 """
 
+import asyncio
+import hashlib
 import os
 import re
 import time
 import logging
-from typing import Any, Dict, List, Optional, Union
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple, TypedDict, Union
 
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.concurrency import run_in_threadpool
+import httpx
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from openai import OpenAI, OpenAIError
-from pydantic import BaseModel
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAIError
 
-logging.basicConfig(level=logging.INFO)
+def parse_log_level(value: str) -> int:
+    """
+    Resolve LOG_LEVEL once so logging and uvicorn agree on it. Accepts level
+    names (including uvicorn's "trace") or numeric levels.
+    """
+    name = value.strip().upper()
+    if name.isdigit():
+        return int(name)
+    if name == "TRACE":
+        return 5  # uvicorn's TRACE_LOG_LEVEL
+    level = logging.getLevelName(name)
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown LOG_LEVEL {value!r}")
+    return level
+
+
+LOG_LEVEL = parse_log_level(os.getenv("LOG_LEVEL", "WARNING"))
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    level=LOG_LEVEL,
+)
 logger = logging.getLogger(__name__)
 
 # Configuration
 DEFAULT_MODEL = os.getenv("GROUNDING_MODEL", "tgi")
-BASE_URL = os.getenv("GROUNDING_BASE_URL", "http://localhost:8080/v1")
+BASE_URL = os.getenv("GROUNDING_BASE_URL", "http://localhost:8000/v1")
 API_KEY = os.getenv("GROUNDING_API_KEY", os.getenv("OPENAI_API_KEY", "dummy"))
 DEFAULT_MAX_TOKENS = int(os.getenv("GROUNDING_MAX_TOKENS", "400"))
+# A single "(x, y)" point needs only a handful of tokens; bounding the
+# decode keeps a rambling answer from costing hundreds of decode steps.
+COORDINATE_MAX_TOKENS = int(os.getenv("GROUNDING_COORD_MAX_TOKENS", "64"))
+REQUEST_TIMEOUT = float(os.getenv("GROUNDING_TIMEOUT", "60"))
+RESULT_CACHE_SIZE = int(os.getenv("GROUNDING_CACHE_SIZE", "256"))
+MAX_CONCURRENCY = int(os.getenv("GROUNDING_MAX_CONCURRENCY", "16"))
+MAX_QUEUE = int(os.getenv("GROUNDING_MAX_QUEUE", "32"))
+if MAX_CONCURRENCY < 1:
+    raise ValueError("GROUNDING_MAX_CONCURRENCY must be at least 1")
+if MAX_QUEUE < 0:
+    raise ValueError("GROUNDING_MAX_QUEUE must not be negative")
+
+_HEALTH_BYTES = orjson.dumps(
+    {"status": "healthy", "model": DEFAULT_MODEL, "base_url": BASE_URL}
+)
+
+_BOX_RE = re.compile(r"(start_box|end_box)='\((\d+),\s*(\d+)\)'")
+_COORD_RE = re.compile(r"(\d+)\D+(\d+)")
+
+
+def _box_replacement(match: "re.Match[str]") -> str:
+    coord_type, x_val, y_val = match.groups()
+    return f"{coord_type}='<|box_start|>({x_val},{y_val})<|box_end|>'"
 
 
 def add_box_token(input_string: str) -> str:
@@ -36,47 +84,93 @@ def add_box_token(input_string: str) -> str:
         actions = input_string.split("Action: ")[1:]
         processed: List[str] = []
         for action in actions:
-            action = action.strip()
-            matches = re.findall(r"(start_box|end_box)='\((\d+),\s*(\d+)\)'", action)
-            updated = action
-            for coord_type, x_val, y_val in matches:
-                needle = f"{coord_type}='({x_val},{y_val})'"
-                replacement = (
-                    f"{coord_type}='<|box_start|>({x_val},{y_val})<|box_end|>'"
-                )
-                updated = updated.replace(needle, replacement)
-            processed.append(updated)
+            processed.append(_BOX_RE.sub(_box_replacement, action.strip()))
         return prefix + "\n\n".join(processed)
     return input_string
 
 
-MessageContent = Union[str, List[Dict[str, Any]]]
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib encoder."""
 
-
-class ChatMessage(BaseModel):
-    role: str
-    content: MessageContent
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
 
-class ChatCompletionRequest(BaseModel):
-    model: Optional[str] = None
-    messages: List[ChatMessage]
-    temperature: Optional[float] = 0.0
-    max_completion_tokens: Optional[int] = None
-    max_tokens: Optional[int] = None
+MessageContent = Union[str, List[Dict[str, Any]]]
 
 
-client: Optional[OpenAI] = None
+class ChatMessage(TypedDict):
+    role: str
+    content: MessageContent
 
 
-def get_client() -> OpenAI:
+def validate_messages(body: Any) -> List[ChatMessage]:
+    """
+    Check only the request shape the proxy relies on; content parts (and
+    their base64 images) are forwarded to the backend untouched.
+    """
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be an object")
+    messages = body.get("messages")
+    if not isinstance(messages, list):
+        raise HTTPException(status_code=400, detail="'messages' must be a list")
+    for message in messages:
+        if not isinstance(message, dict) or not isinstance(message.get("role"), str):
+            raise HTTPException(
+                status_code=400, detail="Each message must have a string 'role'"
+            )
+        if not isinstance(message.get("content"), (str, list)):
+            raise HTTPException(
+                status_code=400,
+                detail="Each message 'content' must be a string or a list",
+            )
+    for field, types, kind in (
+        ("temperature", (int, float), "a number"),
+        ("max_tokens", int, "an integer"),
+        ("max_completion_tokens", int, "an integer"),
+    ):
+        value = body.get(field)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, types):
+            raise HTTPException(status_code=400, detail=f"'{field}' must be {kind}")
+    return messages
+
+
+client: Optional[AsyncOpenAI] = None
+
+
+def get_client() -> AsyncOpenAI:
     global client
     if client is None:
-        client = OpenAI(base_url=BASE_URL, api_key=API_KEY)
+        client = AsyncOpenAI(
+            base_url=BASE_URL,
+            api_key=API_KEY,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=2.0),
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=512, max_keepalive_connections=256)
+            ),
+        )
         logger.info("Initialised OpenAI client with base_url=%s", BASE_URL)
     return client
 
 
+# /grounding/generate always decodes greedily, so identical (screenshot,
+# prompt) pairs - common on agent retries - can skip the backend entirely.
+_result_cache: "OrderedDict[Tuple[bytes, str], Dict[str, Any]]" = OrderedDict()
+
+
+def result_cache_key(prompt: str, image: str) -> Tuple[bytes, str]:
+    return hashlib.blake2b(image.encode(), digest_size=16).digest(), prompt
+
+
+def cache_result(key: Tuple[bytes, str], result: Dict[str, Any]) -> None:
+    _result_cache[key] = result
+    _result_cache.move_to_end(key)
+    if len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+
+
 def ensure_data_url(image: str) -> str:
     return image if image.startswith("data:") else f"data:image/png;base64,{image}"
 
@@ -84,28 +178,23 @@ def ensure_data_url(image: str) -> str:
 def prepare_messages(messages: List[ChatMessage]) -> List[Dict[str, Any]]:
     prepared: List[Dict[str, Any]] = []
     for message in messages:
-        item: Dict[str, Any] = {"role": message.role}
-        content = message.content
-        if isinstance(content, list):
-            parts: List[Any] = []
-            for part in content:
-                if not isinstance(part, dict):
+        role = message["role"]
+        content = message.get("content")
+        # Only assistant turns are rewritten; other content (including
+        # base64 image parts) is forwarded by reference without copying.
+        if role == "assistant":
+            if isinstance(content, list):
+                parts: List[Any] = []
+                for part in content:
+                    if isinstance(part, dict) and isinstance(part.get("text"), str):
+                        updated = dict(part)
+                        updated["text"] = add_box_token(part["text"])
+                        part = updated
                     parts.append(part)
-                    continue
-                updated = dict(part)
-                text_value = updated.get("text")
-                if (
-                    isinstance(text_value, str)
-                    and message.role == "assistant"
-                ):
-                    updated["text"] = add_box_token(text_value)
-                parts.append(updated)
-            item["content"] = parts
-        elif isinstance(content, str) and message.role == "assistant":
-            item["content"] = add_box_token(content)
-        else:
-            item["content"] = content
-        prepared.append(item)
+                content = parts
+            elif isinstance(content, str):
+                content = add_box_token(content)
+        prepared.append({"role": role, "content": content})
     return prepared
 
 
@@ -120,17 +209,35 @@ def extract_response_text(completion: Any) -> str:
     if isinstance(content, list):
         texts: List[str] = []
         for part in content:
-            if isinstance(part, dict):
-                if "text" in part and isinstance(part["text"], str):
-                    texts.append(part["text"])
-                elif "value" in part and isinstance(part["value"], str):
-                    texts.append(part["value"])
+            if not isinstance(part, dict):
+                continue
+            text = part.get("text")
+            if not isinstance(text, str):
+                text = part.get("value")
+            if isinstance(text, str):
+                texts.append(text)
         return "\n".join(texts).strip()
     if isinstance(content, str):
         return content.strip()
     return ""
 
 
+# Admission control: at most MAX_CONCURRENCY backend calls run at once and
+# at most MAX_QUEUE more wait for a slot; beyond that clients get a 503 and
+# back off instead of piling up behind a saturated GPU.
+_backend_slots: Optional[asyncio.Semaphore] = None
+_pending_requests = 0
+
+
+def get_backend_slots() -> asyncio.Semaphore:
+    # Created on first use so it binds to the server's running loop; on
+    # Python 3.9 a Semaphore built at import binds to the default loop.
+    global _backend_slots
+    if _backend_slots is None:
+        _backend_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _backend_slots
+
+
 async def request_chat_completion(
     messages: List[Dict[str, Any]],
     model: Optional[str],
@@ -147,11 +254,15 @@ async def request_chat_completion(
     if effective_max_tokens is not None:
         payload["max_tokens"] = effective_max_tokens
 
-    try:
-        completion = await run_in_threadpool(
-            get_client().chat.completions.create,
-            **payload,
+    global _pending_requests
+    if _pending_requests >= MAX_CONCURRENCY + MAX_QUEUE:
+        raise HTTPException(
+            status_code=503, detail="Grounding backend is busy, retry later"
         )
+    _pending_requests += 1
+    try:
+        async with get_backend_slots():
+            completion = await get_client().chat.completions.create(**payload)
         return completion
     except OpenAIError as exc:
         logger.error("OpenAI backend error: %s", exc)
@@ -159,9 +270,24 @@ async def request_chat_completion(
     except Exception as exc:
         logger.exception("Unexpected backend error")
         raise HTTPException(status_code=500, detail=str(exc)) from exc
+    finally:
+        _pending_requests -= 1
 
 
-app = FastAPI(title="Grounding Model Proxy")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    yield
+    global client
+    if client is not None:
+        await client.close()
+        client = None
+
+
+app = FastAPI(
+    title="Grounding Model Proxy",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -174,7 +300,7 @@ app.add_middleware(
 
 @app.exception_handler(HTTPException)
 async def openai_exception_handler(_request: Request, exc: HTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={
             "error": {
@@ -190,32 +316,40 @@ async def openai_exception_handler(_request: Request, exc: HTTPException):
 
 @app.get("/health")
 async def health_check():
-    return {
-        "status": "healthy",
-        "model": DEFAULT_MODEL,
-        "base_url": BASE_URL,
-    }
+    return Response(_HEALTH_BYTES, media_type="application/json")
 
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
-    messages = prepare_messages(request.messages)
+async def chat_completions(request: Request):
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as exc:
+        raise HTTPException(status_code=400, detail="Invalid JSON body") from exc
+    messages = prepare_messages(validate_messages(body))
     completion = await request_chat_completion(
         messages=messages,
-        model=request.model,
-        temperature=request.temperature,
-        max_tokens=request.max_tokens or request.max_completion_tokens,
+        model=body.get("model"),
+        temperature=body.get("temperature", 0.0),
+        max_tokens=body.get("max_tokens") or body.get("max_completion_tokens"),
     )
     result = completion.model_dump() if hasattr(completion, "model_dump") else completion
     if isinstance(result, dict):
         result.setdefault("id", f"chatcmpl-{int(time.time())}")
         result.setdefault("object", "chat.completion")
         result.setdefault("created", int(time.time()))
-    return result
+    return ORJSONResponse(result)
 
 
 @app.post("/grounding/generate")
 async def grounding_generate(prompt: str, image: str):
+    # With the cache disabled, skip hashing the (multi-MB) image entirely.
+    key = result_cache_key(prompt, image) if RESULT_CACHE_SIZE > 0 else None
+    if key is not None:
+        cached = _result_cache.get(key)
+        if cached is not None:
+            _result_cache.move_to_end(key)
+            return cached
+
     messages = [
         {
             "role": "user",
@@ -229,19 +363,30 @@ async def grounding_generate(prompt: str, image: str):
         messages=messages,
         model=DEFAULT_MODEL,
         temperature=0.0,
-        max_tokens=DEFAULT_MAX_TOKENS,
+        max_tokens=COORDINATE_MAX_TOKENS,
     )
     response_text = extract_response_text(completion)
-    numbers = re.findall(r"\d+", response_text)
-    coordinates = [int(numbers[0]), int(numbers[1])] if len(numbers) >= 2 else None
-    return {
+    match = _COORD_RE.search(response_text)
+    coordinates = [int(match.group(1)), int(match.group(2))] if match else None
+    result = {
         "response": response_text,
         "coordinates": coordinates,
     }
+    # Unparsed replies are not cached so a retry can reach the backend again.
+    if key is not None and coordinates is not None:
+        cache_result(key, result)
+    return result
 
 
 if __name__ == "__main__":
     import uvicorn
 
     logger.info("Starting grounding proxy on %s", BASE_URL)
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8080")),
+        # uvicorn installs its own logging config; without this its access
+        # log would format a line for every request at INFO.
+        log_level=LOG_LEVEL,
+    )
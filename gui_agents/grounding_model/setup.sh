@@ -44,7 +44,9 @@ if [ ! -f ".env" ]; then
 
 # Model configuration
 GROUNDING_MODEL=ByteDance-Seed/UI-TARS-1.5-7B
-DEVICE=cuda  # or "cpu" if no GPU available
+
+# OpenAI-compatible vLLM/TGI backend serving the model
+GROUNDING_BASE_URL=http://localhost:8000/v1
 
 # Server configuration
 HOST=0.0.0.0